@@ -8,6 +8,11 @@ import corsika_wrapper as cw
 import plenopy as pl
 import subprocess
 import glob
+import heapq
+from . import trigger_response
+from . import work_queue
+from . import prefilter
+from . import json_lines
 
 
 def __read_json(path):
@@ -274,6 +279,7 @@ def __summarize_trigger_response(
     detector_truth,
 ):
     tr = unique_id.copy()
+    tr["prefiltered"] = 0
     tr["true_pe_cherenkov"] = int(detector_truth.number_air_shower_pulses())
     tr["trigger_response"] = int(np.max(
         [layer['patch_threshold'] for layer in trigger_responses]))
@@ -285,6 +291,50 @@ def __summarize_trigger_response(
     return tr
 
 
+def __summarize_prefiltered_trigger_response(
+    unique_id,
+    object_distances,
+):
+    tr = unique_id.copy()
+    tr["prefiltered"] = 1
+    tr["true_pe_cherenkov"] = 0
+    tr["trigger_response"] = 0
+    for o in range(len(object_distances)):
+        tr["trigger_{:d}_object_distance".format(o)] = float(
+            object_distances[o])
+        tr["trigger_{:d}_respnse".format(o)] = 0
+    return tr
+
+
+def __append_trigger_response(
+    writer,
+    unique_id,
+    trigger_responses,
+):
+    writer.append(
+        run_id=unique_id["run_id"],
+        event_id=unique_id["event_id"],
+        patch_thresholds=[
+            layer['patch_threshold'] for layer in trigger_responses])
+
+
+def __iter_events_in_order(run, prefiltered_events):
+    """
+    Yields (event_id, is_prefiltered, event) of the propagated events in run
+    and of the prefiltered_events, ordered by event_id.
+    """
+    propagated = (
+        (
+            int(event.simulation_truth.event.corsika_event_header.raw[2-1]),
+            False,
+            event)
+        for event in run)
+    prefiltered = (
+        (int(event["corsika_event_header"][2-1]), True, event)
+        for event in prefiltered_events)
+    return heapq.merge(propagated, prefiltered, key=lambda e: e[0])
+
+
 def __evaluate_trigger_and_export_response(
     run_config,
     merlict_run_path,
@@ -292,63 +342,108 @@ def __evaluate_trigger_and_export_response(
     integration_time_in_slices=5,
     min_number_neighbors=3,
     object_distances=[10e3, 15e3, 20e3],
+    prefiltered_events=[],
 ):
-    run = pl.Run(merlict_run_path)
-    trigger_preparation = pl.trigger.prepare_refocus_sum_trigger(
-        light_field_geometry=run.light_field_geometry,
-        object_distances=object_distances)
-
-    particle_truth_table = []
-    trigger_truth_table = []
-    past_trigger_table = []
-
-    for event in run:
-        trigger_responses = pl.trigger.apply_refocus_sum_trigger(
-            event=event,
-            trigger_preparation=trigger_preparation,
-            min_number_neighbors=min_number_neighbors,
-            integration_time_in_slices=integration_time_in_slices)
-        with open(op.join(event._path, "refocus_sum_trigger.json"), "wt") as f:
-            f.write(json.dumps(trigger_responses, indent=4))
-
-        crunh = event.simulation_truth.event.corsika_run_header.raw
-        cevth = event.simulation_truth.event.corsika_event_header.raw
-
-        particle_truth = __summarize_particle_truth(
-            corsika_run_header=crunh,
-            corsika_event_header=cevth,
-            run_config=run_config)
-        particle_truth_table.append(particle_truth)
-
-        trigger_truth = __summarize_trigger_response(
-            unique_id=__particle_id_run_id_event_id(particle_truth),
-            trigger_responses=trigger_responses,
-            detector_truth=event.simulation_truth.detector)
-        trigger_truth_table.append(trigger_truth)
-
-        if trigger_truth["trigger_response"] >= trigger_treshold:
-            past_trigger_table.append(
-                __particle_id_run_id_event_id(particle_truth))
-            event_filename = '{run_id:06d}{event_id:06d}'.format(
-                run_id=particle_truth["run_id"],
-                event_id=particle_truth["event_id"])
-            event_path = op.join(
-                run_config["past_trigger_dir"],
-                event_filename)
-            sh.copytree(event._path, event_path)
-            pl.tools.acp_format.compress_event_in_place(event_path)
-
-    with open(run_config['particle_truth_table_path'], 'wt') as f:
-        for e in particle_truth_table:
-            f.write(json.dumps(e)+"\n")
-
-    with open(run_config['trigger_truth_table_path'], 'wt') as f:
-        for e in trigger_truth_table:
-            f.write(json.dumps(e)+"\n")
-
-    with open(run_config['past_trigger_table_path'], 'wt') as f:
-        for e in past_trigger_table:
-            f.write(json.dumps(e)+"\n")
+    if merlict_run_path is None:
+        # All events were skipped by the prefilter.
+        run = []
+    else:
+        run = pl.Run(merlict_run_path)
+        trigger_preparation = pl.trigger.prepare_refocus_sum_trigger(
+            light_field_geometry=run.light_field_geometry,
+            object_distances=object_distances)
+
+    table_writer_kwargs = {
+        "chunk_size": run_config['table_chunk_size'],
+        "fsync_num_chunks": run_config['table_fsync_num_chunks']}
+    particle_truth_table = json_lines.Writer(
+        run_config['particle_truth_table_path'], **table_writer_kwargs)
+    trigger_truth_table = json_lines.Writer(
+        run_config['trigger_truth_table_path'], **table_writer_kwargs)
+    # Past-trigger events are copied right away and triggers are rare. So
+    # their table is flushed on every append to always list all copies.
+    # A row is only appended after its event was copied and compressed,
+    # and after the truth tables were synced up to this event. A crashed
+    # run might leave a copied event without a row, but never a row
+    # without its event or its truth.
+    past_trigger_table = json_lines.Writer(
+        run_config['past_trigger_table_path'],
+        chunk_size=1,
+        fsync_num_chunks=1)
+
+    trigger_response_writer = trigger_response.Writer(
+        path=run_config['trigger_response_path'],
+        object_distances=object_distances,
+        **table_writer_kwargs)
+
+    try:
+        for event_id, is_prefiltered, event in __iter_events_in_order(
+            run=run,
+            prefiltered_events=prefiltered_events
+        ):
+            if is_prefiltered:
+                particle_truth = __summarize_particle_truth(
+                    corsika_run_header=event["corsika_run_header"],
+                    corsika_event_header=event["corsika_event_header"],
+                    run_config=run_config)
+                particle_truth_table.append(particle_truth)
+
+                trigger_truth = __summarize_prefiltered_trigger_response(
+                    unique_id=__particle_id_run_id_event_id(particle_truth),
+                    object_distances=object_distances)
+                trigger_truth_table.append(trigger_truth)
+
+                trigger_response_writer.append(
+                    run_id=particle_truth["run_id"],
+                    event_id=particle_truth["event_id"],
+                    patch_thresholds=np.zeros(len(object_distances)),
+                    prefiltered=True)
+                continue
+
+            trigger_responses = pl.trigger.apply_refocus_sum_trigger(
+                event=event,
+                trigger_preparation=trigger_preparation,
+                min_number_neighbors=min_number_neighbors,
+                integration_time_in_slices=integration_time_in_slices)
+
+            crunh = event.simulation_truth.event.corsika_run_header.raw
+            cevth = event.simulation_truth.event.corsika_event_header.raw
+
+            particle_truth = __summarize_particle_truth(
+                corsika_run_header=crunh,
+                corsika_event_header=cevth,
+                run_config=run_config)
+            particle_truth_table.append(particle_truth)
+
+            trigger_truth = __summarize_trigger_response(
+                unique_id=__particle_id_run_id_event_id(particle_truth),
+                trigger_responses=trigger_responses,
+                detector_truth=event.simulation_truth.detector)
+            trigger_truth_table.append(trigger_truth)
+
+            __append_trigger_response(
+                writer=trigger_response_writer,
+                unique_id=__particle_id_run_id_event_id(particle_truth),
+                trigger_responses=trigger_responses)
+
+            if trigger_truth["trigger_response"] >= trigger_treshold:
+                event_filename = '{run_id:06d}{event_id:06d}'.format(
+                    run_id=particle_truth["run_id"],
+                    event_id=particle_truth["event_id"])
+                event_path = op.join(
+                    run_config["past_trigger_dir"],
+                    event_filename)
+                sh.copytree(event._path, event_path)
+                pl.tools.acp_format.compress_event_in_place(event_path)
+                particle_truth_table.sync()
+                trigger_truth_table.sync()
+                past_trigger_table.append(
+                    __particle_id_run_id_event_id(particle_truth))
+    finally:
+        trigger_response_writer.close()
+        particle_truth_table.close()
+        trigger_truth_table.close()
+        past_trigger_table.close()
 
 
 def assert_particle_location_and_deflection_do_match(
@@ -380,8 +475,87 @@ def assert_particle_location_and_deflection_do_match(
     assert np.abs(mdc_loc[mag_z] - loc[mag_z]) <= np.abs(tol*loc[mag_z])
 
 
+def __export_prefilter_report(
+    run_config,
+    num_photons,
+):
+    hopeless = num_photons["hopeless"]
+    report = {
+        "run_id": run_config["run_id"],
+        "prefilter_photon_margin": run_config["prefilter_photon_margin"],
+        "trigger_patch_threshold": run_config["trigger_patch_threshold"],
+        "prefilter_validation": run_config["prefilter_validation"],
+        "num_events": int(num_photons["event_id"].shape[0]),
+        "num_hopeless": int(np.sum(hopeless)),
+    }
+    if run_config["prefilter_validation"]:
+        hopeless_event_ids = set(num_photons["event_id"][hopeless].tolist())
+        lost_triggers = []
+        for tr in json_lines.iter_read(
+            run_config['trigger_truth_table_path']
+        ):
+            if (
+                tr["event_id"] in hopeless_event_ids and
+                tr["trigger_response"] >=
+                run_config["trigger_patch_threshold"]
+            ):
+                lost_triggers.append(tr["event_id"])
+        report["num_hopeless_but_triggered"] = len(lost_triggers)
+        report["hopeless_but_triggered_event_ids"] = lost_triggers
+    with open(run_config['prefilter_report_path'], 'wt') as f:
+        f.write(json.dumps(report, indent=4))
+
+
+def _remove_past_trigger_events_of_run(run_config):
+    """
+    A job might run again after its lease expired. Remove the past-trigger
+    events a previous attempt of this run has left behind.
+    """
+    event_paths = glob.glob(op.join(
+        run_config["past_trigger_dir"],
+        '{run_id:06d}'.format(run_id=run_config["run_id"]) + '[0-9]'*6))
+    for event_path in event_paths:
+        sh.rmtree(event_path)
+
+
+OUTPUT_PATH_KEYS = [
+    'particle_truth_table_path',
+    'trigger_truth_table_path',
+    'past_trigger_table_path',
+    'trigger_response_path',
+    'prefilter_report_path',
+    'merlict_stdout_path',
+    'merlict_stderr_path',
+    'corsika_stdout_path',
+    'corsika_stderr_path',
+]
+
+
+def _redirect_output_to_staging_dir(run_config):
+    """
+    Returns a copy of the run_config which writes all its output into its
+    staging_dir. The work-queue moves the staging_dir into the output_dir
+    once the job is done.
+    """
+    run = dict(run_config)
+    for key in OUTPUT_PATH_KEYS + ['past_trigger_dir']:
+        if key in run:
+            run[key] = op.join(
+                run['staging_dir'],
+                op.relpath(run[key], run['output_dir']))
+            if key == 'past_trigger_dir':
+                os.makedirs(run[key], exist_ok=True)
+            else:
+                os.makedirs(op.dirname(run[key]), exist_ok=True)
+    return run
+
+
 def run_job(job):
-    run = job
+    if 'staging_dir' in job:
+        run = _redirect_output_to_staging_dir(run_config=job)
+    else:
+        run = job
+        _remove_past_trigger_events_of_run(run_config=run)
     with tempfile.TemporaryDirectory(prefix='plenoscope_irf_') as tmp:
         corsika_card_path = op.join(tmp, 'corsika_card.txt')
         corsika_run_path = op.join(tmp, 'cherenkov_photons.evtio')
@@ -400,23 +574,59 @@ def run_job(job):
         sh.copy(corsika_run_path+'.stdout', run['corsika_stdout_path'])
         sh.copy(corsika_run_path+'.stderr', run['corsika_stderr_path'])
 
-        mct_rc = __merlict_plenoscope_propagator(
-            corsika_run_path=corsika_run_path,
-            output_path=merlict_run_path,
-            light_field_geometry_path=run['light_field_geometry_path'],
-            merlict_plenoscope_propagator_path=run[
-                'merlict_plenoscope_propagator_path'],
-            merlict_plenoscope_propagator_config_path=run[
-                'merlict_plenoscope_propagator_config_path'],
-            random_seed=run['run_id'],
-            photon_origins=True)
-
-        sh.copy(merlict_run_path+'.stdout', run['merlict_stdout_path'])
-        sh.copy(merlict_run_path+'.stderr', run['merlict_stderr_path'])
+        use_prefilter = run['prefilter_photon_margin'] is not None
+        prefiltered_events = []
+        if use_prefilter:
+            if run['prefilter_validation']:
+                num_photons = prefilter.filter_events(
+                    corsika_run_path=corsika_run_path,
+                    trigger_patch_threshold=run['trigger_patch_threshold'],
+                    photon_margin=run['prefilter_photon_margin'])
+            else:
+                # The headers of the hopeless events are written to a
+                # small file and streamed from there while the tables are
+                # written.
+                filtered_corsika_run_path = op.join(
+                    tmp, 'cherenkov_photons_prefiltered.evtio')
+                hopeless_headers_path = op.join(
+                    tmp, 'hopeless_headers.jsonl')
+                num_photons = prefilter.filter_events(
+                    corsika_run_path=corsika_run_path,
+                    trigger_patch_threshold=run['trigger_patch_threshold'],
+                    photon_margin=run['prefilter_photon_margin'],
+                    out_path=filtered_corsika_run_path,
+                    hopeless_headers_path=hopeless_headers_path)
+                prefiltered_events = prefilter.iter_hopeless_headers(
+                    hopeless_headers_path)
+                corsika_run_path = filtered_corsika_run_path
+                if np.all(num_photons["hopeless"]):
+                    merlict_run_path = None
+
+        if merlict_run_path is not None:
+            mct_rc = __merlict_plenoscope_propagator(
+                corsika_run_path=corsika_run_path,
+                output_path=merlict_run_path,
+                light_field_geometry_path=run['light_field_geometry_path'],
+                merlict_plenoscope_propagator_path=run[
+                    'merlict_plenoscope_propagator_path'],
+                merlict_plenoscope_propagator_config_path=run[
+                    'merlict_plenoscope_propagator_config_path'],
+                random_seed=run['run_id'],
+                photon_origins=True)
+
+            sh.copy(merlict_run_path+'.stdout', run['merlict_stdout_path'])
+            sh.copy(merlict_run_path+'.stderr', run['merlict_stderr_path'])
 
         __evaluate_trigger_and_export_response(
             run_config=run,
-            merlict_run_path=merlict_run_path)
+            merlict_run_path=merlict_run_path,
+            trigger_treshold=run['trigger_patch_threshold'],
+            prefiltered_events=prefiltered_events)
+
+        if use_prefilter:
+            __export_prefilter_report(
+                run_config=run,
+                num_photons=num_photons)
     return 0
 
 
@@ -460,12 +670,24 @@ def make_output_directory_and_jobs(
     trigger_integration_time_in_slices=5,
     particle_truth_table_dirname='__particle_truth_table',
     trigger_truth_table_dirname='__trigger_truth_table',
-    past_trigger_table_dirname='__past_trigger_table'
+    past_trigger_table_dirname='__past_trigger_table',
+    trigger_response_dirname='__trigger_response',
+    prefilter_photon_margin=None,
+    prefilter_validation=False,
+    prefilter_report_dirname='__prefilter_report',
+    table_chunk_size=100,
+    table_fsync_num_chunks=10,
+    queue_dir=None
 ):
+    assert not prefilter_validation or prefilter_photon_margin is not None, (
+        "The prefilter_validation needs a prefilter_photon_margin.")
+
     od = output_dir
     particle_truth_table_dir = op.join(od, particle_truth_table_dirname)
     trigger_truth_table_dir = op.join(od, trigger_truth_table_dirname)
     past_trigger_table_dir = op.join(od, past_trigger_table_dirname)
+    trigger_response_dir = op.join(od, trigger_response_dirname)
+    prefilter_report_dir = op.join(od, prefilter_report_dirname)
 
     # Make directory tree
     # -------------------
@@ -474,6 +696,8 @@ def make_output_directory_and_jobs(
     os.makedirs(particle_truth_table_dir)
     os.makedirs(trigger_truth_table_dir)
     os.makedirs(past_trigger_table_dir)
+    os.makedirs(trigger_response_dir)
+    os.makedirs(prefilter_report_dir)
     os.makedirs(op.join(od, 'stdout'))
     os.makedirs(op.join(od, 'past_trigger'))
 
@@ -541,6 +765,7 @@ def make_output_directory_and_jobs(
         run_id = energy_bin + 1
         run_id_str = '{:06d}'.format(run_id)
         run["run_id"] = run_id
+        run["output_dir"] = od
         run["energy_bin"] = energy_bin
         run["num_events"] = num_events_in_energy_bin
         run['energy_start'] = edp["energy_bin_edges"][energy_bin]
@@ -577,6 +802,10 @@ def make_output_directory_and_jobs(
             trigger_truth_table_dir, run_id_str+".jsonl")
         run['past_trigger_table_path'] = op.join(
             past_trigger_table_dir, run_id_str+".jsonl")
+        run['trigger_response_path'] = op.join(
+            trigger_response_dir, run_id_str+".trigger_response")
+        run['prefilter_report_path'] = op.join(
+            prefilter_report_dir, run_id_str+".json")
         run['past_trigger_dir'] = op.join(
             od,
             'past_trigger')
@@ -604,7 +833,14 @@ def make_output_directory_and_jobs(
         run['trigger_patch_threshold'] = trigger_patch_threshold
         run['trigger_integration_time_in_slices'] = \
             trigger_integration_time_in_slices
+        run['prefilter_photon_margin'] = prefilter_photon_margin
+        run['prefilter_validation'] = prefilter_validation
+        run['table_chunk_size'] = table_chunk_size
+        run['table_fsync_num_chunks'] = table_fsync_num_chunks
         jobs.append(run)
+
+    if queue_dir is not None:
+        work_queue.put(queue_dir=queue_dir, jobs=jobs)
     return jobs
 
 
@@ -612,5 +848,5 @@ def concatenate_files(wildcard_path, out_path):
     in_paths = glob.glob(wildcard_path)
     with open(out_path, "wt") as fout:
         for in_path in in_paths:
-            with open(in_path, "rt") as fin:
-                fout.write(fin.read())
+            for e in json_lines.iter_read(in_path):
+                fout.write(json.dumps(e)+"\n")
@@ -0,0 +1,73 @@
+"""
+Write tables as json-lines in chunks while the events are processed.
+
+Only complete chunks of lines are written. So a run which crashed still
+leaves a usable table of all the events up to the last chunk.
+"""
+import json
+import os
+
+
+class Writer:
+    def __init__(self, path, chunk_size=100, fsync_num_chunks=10):
+        """
+        Every chunk_size lines are flushed, and every fsync_num_chunks
+        chunks are synced to the disk.
+        """
+        assert chunk_size > 0
+        assert fsync_num_chunks > 0
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fsync_num_chunks = fsync_num_chunks
+        self._f = open(path, 'wt')
+        self._chunk = []
+        self._num_chunks = 0
+
+    def append(self, obj):
+        self._chunk.append(json.dumps(obj)+"\n")
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._chunk) == 0:
+            return
+        self._f.write(''.join(self._chunk))
+        self._f.flush()
+        self._chunk = []
+        self._num_chunks += 1
+        if self._num_chunks % self.fsync_num_chunks == 0:
+            os.fsync(self._f.fileno())
+
+    def sync(self):
+        """
+        Writes all appended lines to the disk, also an incomplete chunk.
+        """
+        self.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.sync()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_read(path):
+    """
+    Skips an incomplete last line left behind by a crashed run.
+    """
+    with open(path, 'rt') as f:
+        for line in f:
+            if not line.endswith("\n"):
+                return
+            yield json.loads(line)
+
+
+def read(path):
+    return list(iter_read(path))
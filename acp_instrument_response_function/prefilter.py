@@ -0,0 +1,187 @@
+"""
+Skip air-showers which can not trigger before they are propagated by merlict.
+
+Every photo-electron needs at least one Cherenkov-photon. So an event with
+less Cherenkov-photons reaching the instrument than the trigger's patch
+threshold can not trigger (ignoring the night-sky-background). This reads
+the number of photons in the photon-bunches of each event from CORSIKA's
+eventio output and writes a copy of the eventio file which only contains the
+events worth propagating. The eventio file is read only once.
+
+Eventio is a sequence of top-level objects. The IACT extension of CORSIKA
+writes
+
+    1200 run header, 1212 input card, 1201 telescope definition,
+    for each event:
+        1202 event header, 1203 array offsets, 1204 telescope data, ...,
+        1209 event end
+    1210 run end
+
+The 1204 telescope data contains one 1205 photon-bunches sub-object for each
+telescope.
+"""
+import numpy as np
+import struct
+from . import json_lines
+
+SYNC_MARKER = b'\x37\x8a\x1f\xd4'
+RUN_HEADER = 1200
+EVENT_HEADER = 1202
+TELESCOPE_DATA = 1204
+PHOTON_BUNCHES = 1205
+EVENT_END = 1209
+
+
+def _parse_header(f, sync_marker=True):
+    """
+    Returns (type, header_size, length) of the object starting at the
+    current position, or None at the end of the file.
+    """
+    header_size = 0
+    if sync_marker:
+        marker = f.read(4)
+        if len(marker) == 0:
+            return None
+        assert marker == SYNC_MARKER, "Expected eventio sync-marker."
+        header_size += 4
+    type_field, _id, length_field = struct.unpack('<IiI', f.read(12))
+    header_size += 12
+    obj_type = type_field & 0xFFFF
+    extended = bool(type_field & (1 << 17))
+    length = length_field & 0x3FFFFFFF
+    if extended:
+        extension, = struct.unpack('<I', f.read(4))
+        header_size += 4
+        length |= (extension & 0x0FFF) << 30
+    return obj_type, header_size, length
+
+
+def _iter_top_level_objects(f):
+    """
+    Yields (type, header, payload) of each top-level object, where header
+    are the raw bytes of the sync-marker and the object-header.
+    """
+    while True:
+        start = f.tell()
+        header = _parse_header(f, sync_marker=True)
+        if header is None:
+            return
+        obj_type, header_size, length = header
+        f.seek(start)
+        yield obj_type, f.read(header_size), f.read(length)
+
+
+def _num_photons_in_telescope_data(payload):
+    num_photons = 0.
+    pos = 0
+    while pos < len(payload):
+        type_field, _id, length_field = struct.unpack(
+            '<IiI', payload[pos:pos + 12])
+        pos += 12
+        length = length_field & 0x3FFFFFFF
+        if type_field & (1 << 17):
+            extension, = struct.unpack('<I', payload[pos:pos + 4])
+            pos += 4
+            length |= (extension & 0x0FFF) << 30
+        if type_field & 0xFFFF == PHOTON_BUNCHES:
+            # int16 array, int16 telescope, float32 photons, int32 bunches
+            num_photons += struct.unpack('<f', payload[pos + 4:pos + 8])[0]
+        pos += length
+    return num_photons
+
+
+def _parse_float_vector(payload):
+    num, = struct.unpack('<i', payload[0:4])
+    return np.frombuffer(payload[4:4 + 4*num], dtype='<f4')
+
+
+def is_hopeless(num_photons, trigger_patch_threshold, photon_margin=1.):
+    """
+    The photon_margin scales the minimal number of photons required.
+    A photon_margin below 1 is more conservative.
+    """
+    return num_photons < photon_margin*trigger_patch_threshold
+
+
+def filter_events(
+    corsika_run_path,
+    trigger_patch_threshold,
+    photon_margin=1.,
+    out_path=None,
+    hopeless_headers_path=None,
+):
+    """
+    Reads the CORSIKA output once and returns the event_id, num_photons,
+    and hopeless of each event.
+    When out_path is given, the CORSIKA output is copied to out_path but
+    without the hopeless events. When hopeless_headers_path is given, the
+    run- and event-headers of the hopeless events are written to it.
+    """
+    event_ids = []
+    num_photons = []
+    hopeless = []
+    fout = None
+    headers = None
+    if out_path is not None:
+        fout = open(out_path, 'wb')
+    if hopeless_headers_path is not None:
+        headers = json_lines.Writer(hopeless_headers_path)
+    try:
+        with open(corsika_run_path, 'rb') as fin:
+            for obj_type, header, payload in _iter_top_level_objects(fin):
+                if obj_type == RUN_HEADER:
+                    run_header = _parse_float_vector(payload)
+                elif obj_type == EVENT_HEADER:
+                    event_header = _parse_float_vector(payload)
+                    event_ids.append(int(event_header[2-1]))
+                    num_photons.append(0.)
+                    if fout is not None:
+                        event_start = fout.tell()
+                elif obj_type == TELESCOPE_DATA:
+                    num_photons[-1] += _num_photons_in_telescope_data(
+                        payload)
+
+                if fout is not None:
+                    fout.write(header)
+                    fout.write(payload)
+
+                if obj_type == EVENT_END:
+                    hopeless.append(bool(is_hopeless(
+                        num_photons=num_photons[-1],
+                        trigger_patch_threshold=trigger_patch_threshold,
+                        photon_margin=photon_margin)))
+                    if hopeless[-1]:
+                        # The event is written while it is read and is
+                        # removed again once it turns out to be hopeless.
+                        if fout is not None:
+                            fout.seek(event_start)
+                            fout.truncate()
+                        if headers is not None:
+                            headers.append({
+                                "corsika_run_header":
+                                    run_header.tolist(),
+                                "corsika_event_header":
+                                    event_header.tolist()})
+    finally:
+        if fout is not None:
+            fout.close()
+        if headers is not None:
+            headers.close()
+    assert len(hopeless) == len(event_ids), "Expected each event to end."
+    return {
+        "event_id": np.array(event_ids, dtype=np.int64),
+        "num_photons": np.array(num_photons, dtype=np.float64),
+        "hopeless": np.array(hopeless, dtype=np.bool_)}
+
+
+def iter_hopeless_headers(hopeless_headers_path):
+    """
+    Yields the CORSIKA run- and event-header of the hopeless events written
+    by filter_events().
+    """
+    for headers in json_lines.iter_read(hopeless_headers_path):
+        yield {
+            "corsika_run_header": np.array(
+                headers["corsika_run_header"], dtype=np.float32),
+            "corsika_event_header": np.array(
+                headers["corsika_event_header"], dtype=np.float32)}
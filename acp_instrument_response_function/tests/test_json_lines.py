@@ -0,0 +1,58 @@
+import acp_instrument_response_function as irf
+import tempfile
+import os
+
+
+def test_chunks_are_written_while_appending():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.jsonl')
+        writer = irf.json_lines.Writer(path, chunk_size=10, fsync_num_chunks=2)
+        for event_id in range(25):
+            writer.append({"run_id": 1, "event_id": event_id})
+        table = irf.json_lines.read(path)
+        assert len(table) == 20
+        assert table[-1]["event_id"] == 19
+        writer.close()
+        table = irf.json_lines.read(path)
+        assert len(table) == 25
+        assert table[-1]["event_id"] == 24
+
+
+def test_sync_writes_incomplete_chunk():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.jsonl')
+        with irf.json_lines.Writer(path, chunk_size=10) as writer:
+            for event_id in range(3):
+                writer.append({"run_id": 1, "event_id": event_id})
+            assert len(irf.json_lines.read(path)) == 0
+            writer.sync()
+            assert len(irf.json_lines.read(path)) == 3
+
+
+def test_incomplete_last_line_is_skipped():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.jsonl')
+        with irf.json_lines.Writer(path) as writer:
+            writer.append({"event_id": 1})
+            writer.append({"event_id": 2})
+        with open(path, 'at') as f:
+            f.write('{"event_id": 3, "tru')
+        table = irf.json_lines.read(path)
+        assert len(table) == 2
+
+
+def test_concatenate_skips_incomplete_last_line_of_crashed_run():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        with irf.json_lines.Writer(os.path.join(tmp, '000001.jsonl')) as w:
+            w.append({"run_id": 1, "event_id": 1})
+        with open(os.path.join(tmp, '000001.jsonl'), 'at') as f:
+            f.write('{"run_id": 1, "event_id": 2, "tru')
+        with irf.json_lines.Writer(os.path.join(tmp, '000002.jsonl')) as w:
+            w.append({"run_id": 2, "event_id": 1})
+
+        out_path = os.path.join(tmp, 'table.jsonl')
+        irf.concatenate_files(os.path.join(tmp, '00000*.jsonl'), out_path)
+        table = irf.json_lines.read(out_path)
+        assert sorted((e["run_id"], e["event_id"]) for e in table) == [
+            (1, 1),
+            (2, 1)]
@@ -0,0 +1,116 @@
+import acp_instrument_response_function as irf
+import numpy as np
+import tempfile
+import struct
+import types
+import os
+
+
+def _object(obj_type, payload, sync_marker=True):
+    out = irf.prefilter.SYNC_MARKER if sync_marker else b''
+    out += struct.pack('<IiI', obj_type, 0, len(payload))
+    return out + payload
+
+
+def _float_vector(header):
+    return struct.pack('<i', len(header)) + header.astype('<f4').tobytes()
+
+
+def _photon_bunches(num_photons):
+    payload = struct.pack('<hhfi', 0, 0, num_photons, 1)
+    payload += np.zeros(8, dtype='<f4').tobytes()
+    return _object(irf.prefilter.PHOTON_BUNCHES, payload, sync_marker=False)
+
+
+def _write_corsika_run(path, num_photons_in_events):
+    runh = np.zeros(273)
+    runh[2-1] = 42
+    with open(path, 'wb') as f:
+        f.write(_object(irf.prefilter.RUN_HEADER, _float_vector(runh)))
+        f.write(_object(1212, b'input card'))
+        for i, num_photons in enumerate(num_photons_in_events):
+            evth = np.zeros(273)
+            evth[2-1] = i + 1
+            f.write(_object(irf.prefilter.EVENT_HEADER, _float_vector(evth)))
+            f.write(_object(1203, b'offsets'))
+            f.write(_object(
+                irf.prefilter.TELESCOPE_DATA,
+                _photon_bunches(num_photons/2) +
+                _photon_bunches(num_photons/2)))
+            f.write(_object(irf.prefilter.EVENT_END, b'event end'))
+        f.write(_object(1210, b'run end'))
+
+
+def test_filter_events_in_one_pass():
+    num_photons_in_events = [0., 1000., 12., 80.]
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, 'cherenkov_photons.evtio')
+        _write_corsika_run(path, num_photons_in_events)
+
+        filtered_path = os.path.join(tmp, 'filtered.evtio')
+        hopeless_headers_path = os.path.join(tmp, 'hopeless_headers.jsonl')
+        events = irf.prefilter.filter_events(
+            corsika_run_path=path,
+            trigger_patch_threshold=67,
+            photon_margin=1.,
+            out_path=filtered_path,
+            hopeless_headers_path=hopeless_headers_path)
+        np.testing.assert_array_equal(events["event_id"], [1, 2, 3, 4])
+        np.testing.assert_array_equal(
+            events["num_photons"],
+            num_photons_in_events)
+        np.testing.assert_array_equal(
+            events["hopeless"],
+            [True, False, True, False])
+
+        headers = list(irf.prefilter.iter_hopeless_headers(
+            hopeless_headers_path))
+        assert len(headers) == 2
+        assert headers[0]["corsika_run_header"][2-1] == 42
+        assert headers[0]["corsika_event_header"][2-1] == 1
+        assert headers[1]["corsika_event_header"][2-1] == 3
+
+        filtered_events = irf.prefilter.filter_events(
+            corsika_run_path=filtered_path,
+            trigger_patch_threshold=67)
+        np.testing.assert_array_equal(filtered_events["event_id"], [2, 4])
+        np.testing.assert_array_equal(
+            filtered_events["num_photons"],
+            [1000., 80.])
+        assert not np.any(filtered_events["hopeless"])
+        assert (
+            os.path.getsize(filtered_path) < os.path.getsize(path))
+
+
+def test_photon_margin_is_conservative():
+    assert not irf.prefilter.is_hopeless(
+        num_photons=50,
+        trigger_patch_threshold=67,
+        photon_margin=0.5)
+    assert irf.prefilter.is_hopeless(
+        num_photons=50,
+        trigger_patch_threshold=67,
+        photon_margin=1.)
+
+
+def _propagated_event(event_id):
+    evth = np.zeros(273)
+    evth[2-1] = event_id
+    return types.SimpleNamespace(
+        simulation_truth=types.SimpleNamespace(
+            event=types.SimpleNamespace(
+                corsika_event_header=types.SimpleNamespace(raw=evth))))
+
+
+def test_prefiltered_events_are_merged_in_order():
+    run = [_propagated_event(i) for i in [2, 4, 5]]
+    prefiltered_events = []
+    for i in [1, 3, 6]:
+        evth = np.zeros(273)
+        evth[2-1] = i
+        prefiltered_events.append({"corsika_event_header": evth})
+    merged = list(irf.__iter_events_in_order(
+        run=run,
+        prefiltered_events=prefiltered_events))
+    assert [m[0] for m in merged] == [1, 2, 3, 4, 5, 6]
+    assert [m[1] for m in merged] == [True, False, True, False, False, True]
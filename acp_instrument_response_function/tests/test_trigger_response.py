@@ -0,0 +1,130 @@
+import acp_instrument_response_function as irf
+import numpy as np
+import tempfile
+import os
+
+
+def test_write_and_read_trigger_response():
+    object_distances = [10e3, 15e3, 20e3]
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.trigger_response')
+        with irf.trigger_response.Writer(
+            path=path,
+            object_distances=object_distances,
+            chunk_size=4
+        ) as writer:
+            for event_id in range(1, 11):
+                writer.append(
+                    run_id=1,
+                    event_id=event_id,
+                    patch_thresholds=[event_id, 2*event_id, 3*event_id],
+                    prefiltered=event_id > 8)
+
+        table = irf.trigger_response.read(path)
+        np.testing.assert_array_equal(
+            table["object_distances"],
+            object_distances)
+        assert np.all(table["run_id"] == 1)
+        np.testing.assert_array_equal(table["event_id"], np.arange(1, 11))
+        assert table["patch_thresholds"].shape == (10, 3)
+        assert np.sum(table["prefiltered"]) == 2
+        assert table["prefiltered"][9]
+        np.testing.assert_array_equal(
+            table["patch_thresholds"][3],
+            [4, 8, 12])
+
+        assert irf.trigger_response.read_patch_time_series(
+            path, run_id=1, event_id=4) is None
+
+
+def test_patch_time_series_is_compressed():
+    object_distances = [10e3, 15e3, 20e3]
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.trigger_response')
+        with irf.trigger_response.Writer(
+            path=path,
+            object_distances=object_distances,
+        ) as writer:
+            for event_id in range(1, 11):
+                writer.append(
+                    run_id=1,
+                    event_id=event_id,
+                    patch_thresholds=[1, 2, 3],
+                    patch_time_series=event_id*np.ones(shape=(3, 70, 50)))
+
+        raw_size = 10*3*70*50*4
+        assert os.path.getsize(path) < raw_size/10
+
+        patch_time_series = irf.trigger_response.read_patch_time_series(
+            path, run_id=1, event_id=7)
+        assert patch_time_series.shape == (3, 70, 50)
+        assert np.all(patch_time_series == 7)
+
+
+def test_events_without_patch_time_series_return_none():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.trigger_response')
+        with irf.trigger_response.Writer(
+            path=path,
+            object_distances=[10e3, 15e3, 20e3],
+            chunk_size=4,
+        ) as writer:
+            for event_id in range(1, 11):
+                patch_time_series = None
+                if event_id % 3 == 0:
+                    patch_time_series = event_id*np.ones(shape=(3, 7, 5))
+                writer.append(
+                    run_id=1,
+                    event_id=event_id,
+                    patch_thresholds=[1, 2, 3],
+                    patch_time_series=patch_time_series)
+
+        for event_id in range(1, 11):
+            patch_time_series = irf.trigger_response.read_patch_time_series(
+                path, run_id=1, event_id=event_id)
+            if event_id % 3 == 0:
+                assert np.all(patch_time_series == event_id)
+            else:
+                assert patch_time_series is None
+
+
+def test_empty_trigger_response():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.trigger_response')
+        irf.trigger_response.Writer(
+            path=path,
+            object_distances=[10e3, 15e3]).close()
+        table = irf.trigger_response.read(path)
+        assert table["event_id"].shape[0] == 0
+        assert table["patch_thresholds"].shape == (0, 2)
+
+
+def test_crashed_run_without_trailer_is_readable():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        path = os.path.join(tmp, '000001.trigger_response')
+        writer = irf.trigger_response.Writer(
+            path=path,
+            object_distances=[10e3, 15e3, 20e3],
+            chunk_size=4)
+        for event_id in range(1, 11):
+            writer.append(
+                run_id=1,
+                event_id=event_id,
+                patch_thresholds=[1, 2, 3],
+                patch_time_series=np.ones(shape=(3, 7, 5)))
+        # The worker dies. The writer is never closed.
+        writer._f.flush()
+
+        table = irf.trigger_response.read(path)
+        np.testing.assert_array_equal(table["event_id"], np.arange(1, 9))
+        patch_time_series = irf.trigger_response.read_patch_time_series(
+            path, run_id=1, event_id=8)
+        assert np.all(patch_time_series == 1)
+
+        # The worker died while writing the last chunk.
+        with open(path, 'rb') as f:
+            content = f.read()
+        with open(path, 'wb') as f:
+            f.write(content[:-10])
+        table = irf.trigger_response.read(path)
+        np.testing.assert_array_equal(table["event_id"], np.arange(1, 5))
@@ -0,0 +1,240 @@
+import acp_instrument_response_function as irf
+import multiprocessing
+import tempfile
+import threading
+import shutil
+import time
+import os
+
+
+def _write_pid(job):
+    with open(job["output_path"], "wt") as f:
+        f.write("{:d}".format(os.getpid()))
+
+
+def _fail(job):
+    raise RuntimeError("This job fails.")
+
+
+def _sleep(job):
+    time.sleep(60.)
+
+
+def _write_and_sleep(job):
+    run = irf._redirect_output_to_staging_dir(run_config=job)
+    with open(run["corsika_stdout_path"], "wt") as f:
+        f.write("partial")
+    time.sleep(60.)
+
+
+def _copy_past_trigger_events(job):
+    job = irf._redirect_output_to_staging_dir(run_config=job)
+    for event_id in range(1, 4):
+        shutil.copytree(
+            job["event_template_dir"],
+            os.path.join(
+                job["past_trigger_dir"],
+                "{:06d}{:06d}".format(job["run_id"], event_id)))
+
+
+def _make_jobs(tmp, num_jobs):
+    return [
+        {"run_id": run_id,
+         "output_path": os.path.join(tmp, "{:06d}.txt".format(run_id))}
+        for run_id in range(1, num_jobs + 1)]
+
+
+def _work(queue_dir):
+    irf.work_queue.work(
+        queue_dir=queue_dir,
+        function=_write_pid,
+        lease_duration=10.,
+        heartbeat_interval=1.,
+        poll_interval=0.01)
+
+
+def test_multiple_workers():
+    NUM_JOBS = 50
+    NUM_WORKERS = 4
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        jobs = _make_jobs(tmp, NUM_JOBS)
+        irf.work_queue.put(queue_dir=queue_dir, jobs=jobs)
+        assert irf.work_queue.status(queue_dir)["pending"] == NUM_JOBS
+
+        workers = [
+            multiprocessing.Process(target=_work, args=(queue_dir,))
+            for i in range(NUM_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        status = irf.work_queue.status(queue_dir)
+        assert status["done"] == NUM_JOBS
+        assert status["pending"] == 0
+        assert status["running"] == 0
+        assert status["failed"] == 0
+        for job in jobs:
+            assert os.path.exists(job["output_path"])
+
+
+def test_expired_lease_is_requeued():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        irf.work_queue.put(queue_dir=queue_dir, jobs=_make_jobs(tmp, 1))
+
+        claim = irf.work_queue.claim(queue_dir)
+        assert claim is not None
+        assert irf.work_queue.claim(queue_dir) is None
+        assert irf.work_queue.requeue_expired(queue_dir, 10.) == 0
+
+        # the worker died long ago
+        past = time.time() - 100.
+        os.utime(os.path.join(queue_dir, "running", claim), (past, past))
+        assert irf.work_queue.requeue_expired(queue_dir, 10.) == 1
+        assert irf.work_queue.status(queue_dir)["pending"] == 1
+
+        _work(queue_dir)
+        assert irf.work_queue.status(queue_dir)["done"] == 1
+
+
+def test_expired_claim_can_not_finish_new_claim():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        irf.work_queue.put(queue_dir=queue_dir, jobs=_make_jobs(tmp, 1))
+
+        claim_a = irf.work_queue.claim(queue_dir)
+        past = time.time() - 100.
+        os.utime(os.path.join(queue_dir, "running", claim_a), (past, past))
+        assert irf.work_queue.requeue_expired(queue_dir, 10.) == 1
+        claim_b = irf.work_queue.claim(queue_dir)
+        assert claim_a != claim_b
+
+        assert not irf.work_queue._move(
+            queue_dir=queue_dir,
+            src_state="running",
+            src_filename=claim_a,
+            dst_state="done",
+            dst_filename="000001.json")
+        status = irf.work_queue.status(queue_dir)
+        assert status["running"] == 1
+        assert status["done"] == 0
+
+
+def test_lost_lease_kills_job():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        irf.work_queue.put(queue_dir=queue_dir, jobs=_make_jobs(tmp, 1))
+        claim = irf.work_queue.claim(queue_dir)
+
+        def requeue():
+            time.sleep(0.5)
+            os.rename(
+                os.path.join(queue_dir, "running", claim),
+                os.path.join(queue_dir, "pending", "000001.json"))
+
+        thief = threading.Thread(target=requeue)
+        thief.start()
+        start = time.time()
+        state = irf.work_queue._run_claimed_job(
+            queue_dir=queue_dir,
+            claim_filename=claim,
+            function=_sleep,
+            heartbeat_interval=0.1)
+        thief.join()
+        assert state == "lost"
+        assert time.time() - start < 30.
+        assert irf.work_queue.status(queue_dir)["pending"] == 1
+
+
+def test_lost_lease_does_not_publish_output():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        output_dir = os.path.join(tmp, "output")
+        os.makedirs(output_dir)
+        irf.work_queue.put(
+            queue_dir=queue_dir,
+            jobs=[{
+                "run_id": 1,
+                "output_dir": output_dir,
+                "corsika_stdout_path": os.path.join(
+                    output_dir, "stdout", "000001_corsika.stdout")}])
+        claim = irf.work_queue.claim(queue_dir)
+
+        def requeue():
+            time.sleep(0.5)
+            os.rename(
+                os.path.join(queue_dir, "running", claim),
+                os.path.join(queue_dir, "pending", "000001.json"))
+
+        thief = threading.Thread(target=requeue)
+        thief.start()
+        state = irf.work_queue._run_claimed_job(
+            queue_dir=queue_dir,
+            claim_filename=claim,
+            function=_write_and_sleep,
+            heartbeat_interval=0.1)
+        thief.join()
+        assert state == "lost"
+        assert not os.path.exists(os.path.join(output_dir, "stdout"))
+        assert os.listdir(os.path.join(output_dir, "__staging")) == []
+
+
+def test_rerun_job_after_its_output_was_partly_written():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        output_dir = os.path.join(tmp, "output")
+        past_trigger_dir = os.path.join(output_dir, "past_trigger")
+        event_template_dir = os.path.join(tmp, "event")
+        os.makedirs(event_template_dir)
+        with open(os.path.join(event_template_dir, "raw"), "wt") as f:
+            f.write("photons")
+        os.makedirs(os.path.join(past_trigger_dir, "000002000001"))
+
+        # A previous claim of run 1 lost its lease after copying one
+        # event into its own staging_dir.
+        os.makedirs(os.path.join(
+            output_dir,
+            "__staging",
+            "000001@old-claim",
+            "past_trigger",
+            "000001000001"))
+
+        irf.work_queue.put(
+            queue_dir=queue_dir,
+            jobs=[{
+                "run_id": 1,
+                "output_dir": output_dir,
+                "past_trigger_dir": past_trigger_dir,
+                "event_template_dir": event_template_dir}])
+        irf.work_queue.work(
+            queue_dir=queue_dir,
+            function=_copy_past_trigger_events,
+            poll_interval=0.01)
+
+        assert irf.work_queue.status(queue_dir)["done"] == 1
+        assert sorted(os.listdir(past_trigger_dir)) == [
+            "000001000001",
+            "000001000002",
+            "000001000003",
+            "000002000001"]
+        assert os.path.exists(
+            os.path.join(past_trigger_dir, "000001000001", "raw"))
+        assert os.listdir(os.path.join(output_dir, "__staging")) == [
+            "000001@old-claim"]
+
+
+def test_failed_job():
+    with tempfile.TemporaryDirectory(prefix='acp_irf_') as tmp:
+        queue_dir = os.path.join(tmp, "queue")
+        irf.work_queue.put(queue_dir=queue_dir, jobs=_make_jobs(tmp, 1))
+        num_jobs = irf.work_queue.work(
+            queue_dir=queue_dir,
+            function=_fail,
+            poll_interval=0.01)
+        assert num_jobs == 1
+        assert irf.work_queue.status(queue_dir)["failed"] == 1
+        assert os.path.exists(
+            os.path.join(queue_dir, "failed", "000001.json.stderr"))
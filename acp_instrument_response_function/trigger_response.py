@@ -0,0 +1,313 @@
+"""
+Compact, columnar storage of the refocus-sum-trigger's responses.
+
+All events of one run go into one file. The file starts with a header
+
+    8 bytes MAGIC
+    int32 num_foci
+    float64[num_foci] object_distances
+
+followed by chunks of events. Each chunk stores its events column by column
+
+    int32 num_events
+    int32 num_patches, (0 when no time-series was exported)
+    int32 num_time_slices, (0 when no time-series was exported)
+    int64 num_compressed_bytes, of the time-series
+    int32[num_events] run_id
+    int32[num_events] event_id
+    uint8[num_events] prefiltered, (1 when skipped before the propagation)
+    uint8[num_events] has_time_series
+    int32[num_events, num_foci] patch_thresholds
+    zlib(int32[num_with_time_series, num_foci, num_patches, num_time_slices])
+
+and the file ends with an index of the chunks and a trailer
+
+    int64[num_chunks] chunk_offsets
+    int64 num_chunks
+    8 bytes MAGIC
+
+The chunks are written while the events are processed. When a run crashed
+and left no trailer, the reader finds the complete chunks by walking from
+one chunk-header to the next.
+
+Reading the patch_thresholds only touches the small columns and skips the
+compressed time-series. The time-series of each event is compressed as soon
+as it is appended, so only the compressed time-series of a chunk are held in
+memory.
+"""
+import numpy as np
+import struct
+import zlib
+import os
+
+MAGIC = b'ACPTRG03'
+CHUNK_HEADER_FORMAT = '<iiiq'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+TRAILER_FORMAT = '<q8s'
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+
+
+class Writer:
+    def __init__(
+        self,
+        path,
+        object_distances,
+        chunk_size=100,
+        fsync_num_chunks=10,
+    ):
+        """
+        Every chunk_size events are flushed, and every fsync_num_chunks
+        chunks are synced to the disk.
+        """
+        assert chunk_size > 0
+        assert fsync_num_chunks > 0
+        self.path = path
+        self.object_distances = np.asarray(object_distances, dtype='<f8')
+        self.num_foci = self.object_distances.shape[0]
+        self.chunk_size = chunk_size
+        self.fsync_num_chunks = fsync_num_chunks
+        self._f = open(path, 'wb')
+        self._f.write(MAGIC)
+        self._f.write(struct.pack('<i', self.num_foci))
+        self._f.write(self.object_distances.tobytes())
+        self._chunk_offsets = []
+        self._start_chunk()
+
+    def _start_chunk(self):
+        self._chunk = []
+        self._compressor = zlib.compressobj()
+        self._compressed_time_series = []
+        self._time_series_shape = None
+
+    def append(
+        self,
+        run_id,
+        event_id,
+        patch_thresholds,
+        patch_time_series=None,
+        prefiltered=False,
+    ):
+        patch_thresholds = np.asarray(patch_thresholds, dtype='<i4')
+        assert patch_thresholds.shape == (self.num_foci, )
+        has_time_series = patch_time_series is not None
+        if has_time_series:
+            patch_time_series = np.asarray(patch_time_series, dtype='<i4')
+            assert patch_time_series.ndim == 3
+            assert patch_time_series.shape[0] == self.num_foci
+            if self._time_series_shape is None:
+                self._time_series_shape = patch_time_series.shape
+            assert patch_time_series.shape == self._time_series_shape
+            self._compressed_time_series.append(
+                self._compressor.compress(patch_time_series.tobytes()))
+        self._chunk.append((
+            run_id,
+            event_id,
+            patch_thresholds,
+            has_time_series,
+            prefiltered))
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._chunk) == 0:
+            return
+        num_events = len(self._chunk)
+        run_ids = np.array([e[0] for e in self._chunk], dtype='<i4')
+        event_ids = np.array([e[1] for e in self._chunk], dtype='<i4')
+        prefiltered = np.array([e[4] for e in self._chunk], dtype='<u1')
+        has_time_series = np.array(
+            [e[3] for e in self._chunk], dtype='<u1')
+        patch_thresholds = np.array(
+            [e[2] for e in self._chunk], dtype='<i4').reshape(
+                (num_events, self.num_foci))
+
+        if self._time_series_shape is not None:
+            self._compressed_time_series.append(self._compressor.flush())
+            compressed_time_series = b''.join(self._compressed_time_series)
+            num_patches = self._time_series_shape[1]
+            num_time_slices = self._time_series_shape[2]
+        else:
+            compressed_time_series = b''
+            num_patches = 0
+            num_time_slices = 0
+
+        self._chunk_offsets.append(self._f.tell())
+        self._f.write(struct.pack(
+            CHUNK_HEADER_FORMAT,
+            num_events,
+            num_patches,
+            num_time_slices,
+            len(compressed_time_series)))
+        self._f.write(run_ids.tobytes())
+        self._f.write(event_ids.tobytes())
+        self._f.write(prefiltered.tobytes())
+        self._f.write(has_time_series.tobytes())
+        self._f.write(patch_thresholds.tobytes())
+        self._f.write(compressed_time_series)
+        self._f.flush()
+        self._start_chunk()
+        if len(self._chunk_offsets) % self.fsync_num_chunks == 0:
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.flush()
+        chunk_offsets = np.array(self._chunk_offsets, dtype='<i8')
+        self._f.write(chunk_offsets.tobytes())
+        self._f.write(struct.pack(
+            TRAILER_FORMAT,
+            chunk_offsets.shape[0],
+            MAGIC))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_header(f):
+    f.seek(0)
+    magic = f.read(len(MAGIC))
+    assert magic == MAGIC, (
+        "Expected trigger-response-file to start with {:s}.".format(
+            str(MAGIC)))
+    num_foci, = struct.unpack('<i', f.read(4))
+    object_distances = np.frombuffer(f.read(8*num_foci), dtype='<f8')
+    return object_distances
+
+
+def _chunk_size_in_file(f, offset, num_foci):
+    f.seek(offset)
+    (
+        num_events,
+        _num_patches,
+        _num_time_slices,
+        num_compressed_bytes
+    ) = struct.unpack(CHUNK_HEADER_FORMAT, f.read(CHUNK_HEADER_SIZE))
+    return (
+        CHUNK_HEADER_SIZE +
+        4*num_events +
+        4*num_events +
+        num_events +
+        num_events +
+        4*num_events*num_foci +
+        num_compressed_bytes)
+
+
+def _scan_chunk_offsets(f, num_foci):
+    """
+    Walks the chunks when the trailer is missing and ignores an incomplete
+    last chunk.
+    """
+    file_size = f.seek(0, 2)
+    offset = len(MAGIC) + 4 + 8*num_foci
+    chunk_offsets = []
+    while offset + CHUNK_HEADER_SIZE <= file_size:
+        chunk_size = _chunk_size_in_file(f, offset, num_foci)
+        if offset + chunk_size > file_size:
+            break
+        chunk_offsets.append(offset)
+        offset += chunk_size
+    return np.array(chunk_offsets, dtype='<i8')
+
+
+def _read_chunk_offsets(f, num_foci):
+    file_size = f.seek(0, 2)
+    if file_size >= TRAILER_SIZE:
+        f.seek(-TRAILER_SIZE, 2)
+        num_chunks, magic = struct.unpack(
+            TRAILER_FORMAT,
+            f.read(TRAILER_SIZE))
+        if magic == MAGIC:
+            f.seek(-TRAILER_SIZE - 8*num_chunks, 2)
+            return np.frombuffer(f.read(8*num_chunks), dtype='<i8')
+    return _scan_chunk_offsets(f, num_foci)
+
+
+def _read_chunk(f, offset, num_foci, read_time_series=False):
+    f.seek(offset)
+    (
+        num_events,
+        num_patches,
+        num_time_slices,
+        num_compressed_bytes
+    ) = struct.unpack(CHUNK_HEADER_FORMAT, f.read(CHUNK_HEADER_SIZE))
+    chunk = {
+        "run_id": np.frombuffer(f.read(4*num_events), dtype='<i4'),
+        "event_id": np.frombuffer(f.read(4*num_events), dtype='<i4'),
+        "prefiltered": np.frombuffer(
+            f.read(num_events), dtype='<u1').astype(np.bool_),
+        "has_time_series": np.frombuffer(
+            f.read(num_events), dtype='<u1').astype(np.bool_),
+        "patch_thresholds": np.frombuffer(
+            f.read(4*num_events*num_foci),
+            dtype='<i4').reshape((num_events, num_foci)),
+        "patch_time_series": None}
+    if read_time_series and num_patches > 0:
+        chunk["patch_time_series"] = np.frombuffer(
+            zlib.decompress(f.read(num_compressed_bytes)),
+            dtype='<i4').reshape(
+                (-1, num_foci, num_patches, num_time_slices))
+    return chunk
+
+
+def read(path):
+    """
+    Returns the columns run_id, event_id, prefiltered, and patch_thresholds
+    of all events in the file, and the object_distances of the foci.
+    """
+    with open(path, 'rb') as f:
+        object_distances = _read_header(f)
+        num_foci = object_distances.shape[0]
+        chunks = [
+            _read_chunk(f=f, offset=int(offset), num_foci=num_foci)
+            for offset in _read_chunk_offsets(f, num_foci)]
+    return {
+        "object_distances": object_distances,
+        "run_id": np.concatenate(
+            [c["run_id"] for c in chunks] +
+            [np.zeros(0, dtype='<i4')]),
+        "event_id": np.concatenate(
+            [c["event_id"] for c in chunks] +
+            [np.zeros(0, dtype='<i4')]),
+        "prefiltered": np.concatenate(
+            [c["prefiltered"] for c in chunks] +
+            [np.zeros(0, dtype=np.bool_)]),
+        "patch_thresholds": np.concatenate(
+            [c["patch_thresholds"] for c in chunks] +
+            [np.zeros((0, num_foci), dtype='<i4')])}
+
+
+def read_patch_time_series(path, run_id, event_id):
+    """
+    Returns the patch_time_series [foci, patches, time_slices] of the event,
+    or None when it was not exported.
+    """
+    with open(path, 'rb') as f:
+        num_foci = _read_header(f).shape[0]
+        for offset in _read_chunk_offsets(f, num_foci):
+            chunk = _read_chunk(f=f, offset=int(offset), num_foci=num_foci)
+            match = np.where(
+                (chunk["run_id"] == run_id) &
+                (chunk["event_id"] == event_id))[0]
+            if match.shape[0] > 0:
+                i = match[0]
+                if not chunk["has_time_series"][i]:
+                    return None
+                chunk = _read_chunk(
+                    f=f,
+                    offset=int(offset),
+                    num_foci=num_foci,
+                    read_time_series=True)
+                # The time-series are only stored for the events which
+                # have one.
+                j = int(np.sum(chunk["has_time_series"][0:i]))
+                return chunk["patch_time_series"][j]
+    raise KeyError(
+        "No trigger-response for run {:d}, event {:d}.".format(
+            run_id, event_id))
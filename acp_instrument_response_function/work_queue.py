@@ -0,0 +1,326 @@
+"""
+A work-queue on a shared file-system.
+Start a worker on any node with
+python -m acp_instrument_response_function.work_queue QUEUE_DIR
+
+Usage:
+    work_queue.py QUEUE_DIR [options]
+
+Options:
+    --lease=SECONDS         Lease after which a job without heartbeat is
+                            handed to another worker. [default: 3600]
+    --heartbeat=SECONDS     Interval to renew the lease. [default: 60]
+    --poll=SECONDS          Interval to look for new jobs. [default: 10]
+
+Jobs are json-files which move between the directories
+
+    pending/ -> running/ -> done/
+                         -> failed/
+
+Each move is an os.rename() which is atomic on a posix file-system. Thus
+a job is claimed by exactly one worker. A claimed job is renamed to
+running/<job>@<claim>.json where <claim> is unique to the claim. Only the
+claim's owner moves this name on, so a worker whose lease expired can not
+finish a job another worker has claimed since.
+
+The modification-time of a running job is its heartbeat. A running job
+whose heartbeat is older than the lease is moved back to pending/, e.g. when
+its worker died. The lease must be much longer than both the
+heartbeat-interval and the clock-skew between the nodes.
+
+Each job runs in its own process-group. When a worker finds its claim gone,
+it lost the lease and kills the job.
+
+A job with an output_dir gets a staging_dir output_dir/__staging/<claim>
+which is unique to its claim and must write all its output there. A killed
+job might still write for up to a heartbeat-interval, but only into the
+staging_dir of its own claim. When the job is done, the claim's owner renames
+its claim to running/<job>@<claim>.publishing, which fails when the lease
+was lost, moves the staging_dir's content into the output_dir, and then
+moves the job to done/. A worker which dies while publishing leaves the
+.publishing claim behind in running/ where it is not requeued.
+"""
+import os
+from os import path as op
+import sys
+import json
+import time
+import uuid
+import signal
+import socket
+import multiprocessing
+import traceback
+import shutil
+
+STAGING_DIRNAME = '__staging'
+PUBLISHING_SUFFIX = '.publishing'
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+LOST = 'lost'
+
+
+def _job_filename(job_id):
+    return '{:06d}.json'.format(job_id)
+
+
+def _claim_filename(filename):
+    claim_id = '{:s}.{:d}.{:s}'.format(
+        socket.gethostname(),
+        os.getpid(),
+        uuid.uuid4().hex[0:8])
+    return filename[:-len('.json')] + '@' + claim_id + '.json'
+
+
+def _job_filename_of_claim(claim_filename):
+    return claim_filename.split('@')[0] + '.json'
+
+
+def _write_json_atomic(path, obj):
+    tmp_path = path + '.{:s}.{:d}.tmp'.format(
+        socket.gethostname(),
+        os.getpid())
+    with open(tmp_path, 'wt') as f:
+        f.write(json.dumps(obj, indent=4, default=lambda o: o.item()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, 'rt') as fin:
+        return json.loads(fin.read())
+
+
+def _list_jobs(queue_dir, state):
+    return sorted(
+        f for f in os.listdir(op.join(queue_dir, state))
+        if f.endswith('.json'))
+
+
+def _move(queue_dir, src_state, src_filename, dst_state, dst_filename):
+    """
+    Returns False when the job is not in src_state anymore.
+    """
+    try:
+        os.rename(
+            op.join(queue_dir, src_state, src_filename),
+            op.join(queue_dir, dst_state, dst_filename))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _publish(staging_dir, output_dir):
+    """
+    Moves the content of staging_dir into output_dir. Directories which
+    exist in both are merged.
+    """
+    for name in os.listdir(staging_dir):
+        src = op.join(staging_dir, name)
+        dst = op.join(output_dir, name)
+        if op.isdir(src) and op.isdir(dst):
+            _publish(src, dst)
+        else:
+            os.replace(src, dst)
+    os.rmdir(staging_dir)
+
+
+def make_queue(queue_dir):
+    for state in [PENDING, RUNNING, DONE, FAILED]:
+        os.makedirs(op.join(queue_dir, state), exist_ok=True)
+
+
+def put(queue_dir, jobs):
+    make_queue(queue_dir)
+    for job in jobs:
+        _write_json_atomic(
+            path=op.join(queue_dir, PENDING, _job_filename(job['run_id'])),
+            obj=job)
+
+
+def status(queue_dir):
+    return {
+        state: len(_list_jobs(queue_dir, state))
+        for state in [PENDING, RUNNING, DONE, FAILED]}
+
+
+def requeue_expired(queue_dir, lease_duration):
+    now = time.time()
+    num_requeued = 0
+    for claim_filename in _list_jobs(queue_dir, RUNNING):
+        try:
+            heartbeat = os.stat(
+                op.join(queue_dir, RUNNING, claim_filename)).st_mtime
+        except FileNotFoundError:
+            continue
+        if now - heartbeat > lease_duration:
+            if _move(
+                queue_dir=queue_dir,
+                src_state=RUNNING,
+                src_filename=claim_filename,
+                dst_state=PENDING,
+                dst_filename=_job_filename_of_claim(claim_filename)
+            ):
+                num_requeued += 1
+    return num_requeued
+
+
+def claim(queue_dir):
+    """
+    Returns the filename of the claim in running/, or None when no job is
+    pending.
+    """
+    for filename in _list_jobs(queue_dir, PENDING):
+        # Renew the heartbeat before the rename to not let the job look
+        # expired to other workers once it is running.
+        try:
+            os.utime(op.join(queue_dir, PENDING, filename))
+        except FileNotFoundError:
+            continue
+        claim_filename = _claim_filename(filename)
+        if _move(
+            queue_dir=queue_dir,
+            src_state=PENDING,
+            src_filename=filename,
+            dst_state=RUNNING,
+            dst_filename=claim_filename
+        ):
+            os.utime(op.join(queue_dir, RUNNING, claim_filename))
+            return claim_filename
+    return None
+
+
+def _run_in_own_process_group(function, job, stderr_path):
+    os.setpgid(0, 0)
+    try:
+        function(job)
+    except Exception:
+        with open(stderr_path, 'wt') as f:
+            f.write(traceback.format_exc())
+        sys.exit(1)
+
+
+def _run_claimed_job(queue_dir, claim_filename, function, heartbeat_interval):
+    """
+    Returns DONE, FAILED, or LOST when the lease was lost.
+    """
+    running_path = op.join(queue_dir, RUNNING, claim_filename)
+    stderr_path = running_path[:-len('.json')] + '.stderr'
+    filename = _job_filename_of_claim(claim_filename)
+
+    job = _read_json(running_path)
+    staging_dir = None
+    if 'output_dir' in job:
+        staging_dir = op.join(
+            job['output_dir'],
+            STAGING_DIRNAME,
+            claim_filename[:-len('.json')])
+        job['staging_dir'] = staging_dir
+
+    proc = multiprocessing.get_context('fork').Process(
+        target=_run_in_own_process_group,
+        args=(function, job, stderr_path))
+    proc.start()
+    while True:
+        proc.join(heartbeat_interval)
+        if proc.exitcode is not None:
+            break
+        try:
+            os.utime(running_path)
+        except FileNotFoundError:
+            # The lease expired and the job might run somewhere else.
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                proc.kill()
+            proc.join()
+            break
+
+    if proc.exitcode == 0 and staging_dir is not None:
+        publishing_filename = claim_filename + PUBLISHING_SUFFIX
+        if not _move(
+            queue_dir=queue_dir,
+            src_state=RUNNING,
+            src_filename=claim_filename,
+            dst_state=RUNNING,
+            dst_filename=publishing_filename
+        ):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return LOST
+        if op.exists(staging_dir):
+            _publish(staging_dir=staging_dir, output_dir=job['output_dir'])
+        _move(
+            queue_dir=queue_dir,
+            src_state=RUNNING,
+            src_filename=publishing_filename,
+            dst_state=DONE,
+            dst_filename=filename)
+        return DONE
+
+    if staging_dir is not None:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    if proc.exitcode == 0:
+        dst_state = DONE
+    else:
+        dst_state = FAILED
+    if not _move(
+        queue_dir=queue_dir,
+        src_state=RUNNING,
+        src_filename=claim_filename,
+        dst_state=dst_state,
+        dst_filename=filename
+    ):
+        if op.exists(stderr_path):
+            os.remove(stderr_path)
+        return LOST
+    if op.exists(stderr_path):
+        os.rename(
+            stderr_path,
+            op.join(queue_dir, FAILED, filename + '.stderr'))
+    return dst_state
+
+
+def work(
+    queue_dir,
+    function,
+    lease_duration=3600.,
+    heartbeat_interval=60.,
+    poll_interval=10.,
+):
+    """
+    Runs pending jobs with function(job) until no job is pending or
+    running anymore. Any number of workers on any number of nodes can work
+    on the same queue_dir at the same time.
+    """
+    assert heartbeat_interval < lease_duration
+    num_jobs = 0
+    while True:
+        requeue_expired(queue_dir, lease_duration=lease_duration)
+        claim_filename = claim(queue_dir)
+        if claim_filename is not None:
+            _run_claimed_job(
+                queue_dir=queue_dir,
+                claim_filename=claim_filename,
+                function=function,
+                heartbeat_interval=heartbeat_interval)
+            num_jobs += 1
+        elif len(_list_jobs(queue_dir, RUNNING)) > 0:
+            # A running job might still expire and come back to pending.
+            time.sleep(poll_interval)
+        else:
+            return num_jobs
+
+
+if __name__ == '__main__':
+    import docopt
+    import acp_instrument_response_function as irf
+
+    arguments = docopt.docopt(__doc__)
+    work(
+        queue_dir=arguments['QUEUE_DIR'],
+        function=irf.run_job,
+        lease_duration=float(arguments['--lease']),
+        heartbeat_interval=float(arguments['--heartbeat']),
+        poll_interval=float(arguments['--poll']))
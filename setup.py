@@ -23,7 +23,6 @@ setuptools.setup(
         os.path.join('tests', 'resources', '*')]},
     install_requires=[
         'docopt',
-        'scoop',
     ],
     classifiers=[
         "Programming Language :: Python :: 3",